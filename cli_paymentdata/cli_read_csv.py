@@ -1,20 +1,387 @@
 import argparse
+import bisect
 import csv
+import datetime
+import hashlib
+import io
 import json
 import jsonschema
 import logging
 import requests
 import os
+import re
+import sqlite3
+import sys
+import zlib
 
 from collections import defaultdict
-from typing import Union, Dict, List
+from collections.abc import Mapping
+from typing import Any, Iterable, Iterator, Optional, Tuple, Union, Dict, List
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class JSONEncoderBackend:
+    """
+    Encode payload data to JSON bytes with orjson if installed, else stdlib json.
+
+    `separator` is the item separator of the backend, so that a list of
+    fragments joined with it gives the same bytes as encoding the whole list.
+    """
+
+    backends = ["auto", "orjson", "json"]
+
+    def __init__(self, backend: str = "auto"):
+        if backend not in self.backends:
+            raise ValueError(
+                f"JSON backend {backend} not supported. Please use one of {self.backends}."  # noqa: E501
+            )
+        if backend == "auto":
+            backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None:
+            raise ValueError("JSON backend orjson requested but it is not installed.")
+        self.name: str = backend
+        self.separator: bytes = b"," if backend == "orjson" else b", "
+
+    def dumps(self, data: Any) -> bytes:
+        """
+        Encode data to JSON bytes.
+        """
+        if self.name == "orjson":
+            try:
+                return orjson.dumps(data)
+            except orjson.JSONEncodeError:
+                # e.g. integers over 64 bits, which stdlib json supports.
+                # Same compact separators as orjson, so fragments still join.
+                return json.dumps(
+                    data, separators=(",", ":"), ensure_ascii=False
+                ).encode("utf-8")
+        return json.dumps(data).encode("utf-8")
+
+    def join(self, fragments: Iterable[bytes]) -> bytes:
+        """
+        Build a JSON array from already encoded fragments.
+        """
+        return b"[" + self.separator.join(fragments) + b"]"
+
+    def iter_join(
+        self, fragments: Iterable[bytes], chunk_size: int = 64 * 1024
+    ) -> Iterator[bytes]:
+        """
+        Build a JSON array from already encoded fragments, in chunks of about
+        `chunk_size` bytes, so the whole array is never held in memory.
+        """
+        chunk = bytearray(b"[")
+        for i, fragment in enumerate(fragments):
+            if i:
+                chunk += self.separator
+            chunk += fragment
+            if len(chunk) >= chunk_size:
+                yield bytes(chunk)
+                chunk.clear()
+        chunk += b"]"
+        yield bytes(chunk)
+
+
+def parse_positive_int(value: str) -> int:
+    """
+    Parse an integer of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"Value {value} not supported. Please use an integer >= 1."
+        )
+    return number
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as `i/N`, with `i` from 0 to N - 1.
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Shard {shard} not supported. Please use i/N, e.g. 0/4."
+        )
+    if not _valid_shard(index, count):
+        raise argparse.ArgumentTypeError(
+            f"Shard {shard} not supported. Please use 0 <= i < N."
+        )
+    return index, count
+
+
+def _valid_shard(index: int, count: int) -> bool:
+    return count >= 1 and 0 <= index < count
+
+
+def parse_shard_count(count: str) -> int:
+    """
+    Parse a number of shards N, at least 1.
+    """
+    try:
+        number = int(count)
+    except ValueError:
+        number = 0
+    if not _valid_shard(0, number):
+        raise argparse.ArgumentTypeError(
+            f"Number of shards {count} not supported. Please use N >= 1."
+        )
+    return number
+
+
+def in_shard(customer_id: Optional[str], shard: Optional[Tuple[int, int]]) -> bool:
+    """
+    Check if a customer belongs to a shard.
+    CRC32 of the customer_id is used as it is stable across runs and hosts,
+    unlike the built-in `hash`.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32((customer_id or "").encode("utf-8")) % count == index
+
+
+def shard_reports_dir(shard: Optional[Tuple[int, int]]) -> str:
+    """
+    Get the reports directory of a shard.
+    """
+    if shard is None:
+        return "reports"
+    return f"reports/shard_{shard[0]}_of_{shard[1]}"
+
+
+# Same format as `purchased_at` in the purchase schema
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def parse_date(date: str) -> str:
+    """
+    Check a date given as `YYYY-MM-DD`.
+    """
+    try:
+        return datetime.date.fromisoformat(date).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Date {date} not supported. Please use YYYY-MM-DD."
+        )
+
+
+def date_index_path(purchases_file: str) -> str:
+    """
+    Get the path of the sidecar date index of a purchases file.
+    """
+    return f"{purchases_file}.dateidx.json"
+
+
+def build_date_index(purchases_file: str) -> str:
+    """
+    Save a sparse index with the byte offset of the first row of each date.
+    The purchases file must be sorted by date, have `YYYY-MM-DD` dates only
+    and one row per line.
+    """
+    dates: List[List] = []
+    with open(purchases_file, "rb") as p:
+        header = next(csv.reader([p.readline().decode("utf-8")], delimiter=";"))
+        date_column = header.index("date")
+        offset = p.tell()
+        for line in p:
+            row = next(csv.reader([line.decode("utf-8")], delimiter=";"), [])
+            if row:
+                date = row[date_column] if len(row) > date_column else ""
+                if not DATE_PATTERN.match(date):
+                    # Rows out of the slice are never read, bad dates included
+                    msg = f"{purchases_file} has a row without a YYYY-MM-DD date: {line!r}."  # noqa: E501
+                    logging.error(msg)
+                    raise ValueError(msg)
+                if dates and date < dates[-1][0]:
+                    msg = f"{purchases_file} is not sorted by date: {date} after {dates[-1][0]}."  # noqa: E501
+                    logging.error(msg)
+                    raise ValueError(msg)
+                if not dates or date != dates[-1][0]:
+                    dates.append([date, offset])
+            offset += len(line)
+
+    stat = os.stat(purchases_file)
+    index_file = date_index_path(purchases_file)
+    with open(index_file, "w") as json_file:
+        json.dump(
+            {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "dates": dates},
+            json_file,
+        )
+    logging.info(f"Date index of {len(dates)} dates exported to {index_file}")
+    return index_file
+
+
+def load_date_index(purchases_file: str) -> Optional[List[Tuple[str, int]]]:
+    """
+    Load the date index of a purchases file, if it exists and is up to date.
+    """
+    index_file = date_index_path(purchases_file)
+    if not os.path.exists(index_file):
+        return None
+    stat = os.stat(purchases_file)
+    try:
+        with open(index_file) as json_file:
+            index = json.load(json_file)
+        up_to_date = (
+            index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns
+        )
+        dates = [(str(date), int(offset)) for date, offset in index["dates"]]
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Date index {index_file} is not valid: {e} // not used")
+        return None
+    if not up_to_date:
+        logging.warning(f"Date index {index_file} is out of date // not used")
+        return None
+    return dates
+
+
+class SpillingPurchaseStore(Mapping):
+    """
+    Group purchases per customer under a memory budget.
+
+    When the estimated size of the in-memory groups goes over `max_memory`
+    (in bytes), the largest groups are moved to a temporary on-disk SQLite
+    database. Reading a customer returns its spilled purchases followed by the
+    ones still in memory, so the order matches the in-memory path.
+    Purchases read back from disk are new objects, so their strings are no
+    longer interned.
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory: int = max_memory
+        self.memory_used: int = 0
+        self.spilled_groups: int = 0
+        # customer_id -> group index, in order of first appearance
+        self._groups: Dict[Any, int] = {}
+        self._in_memory: Dict[int, List[Dict]] = {}
+        self._group_sizes: Dict[int, int] = {}
+        self._on_disk: set = set()
+        self._seq: int = 0
+
+        # An empty filename makes SQLite use a private temporary file
+        # which is deleted when the connection is closed.
+        self._db = sqlite3.connect("")
+        self._db.execute("PRAGMA cache_size = -1024")
+        self._db.execute(
+            "CREATE TABLE purchases (grp INTEGER, seq INTEGER, data TEXT)"
+        )
+        self._db.execute("CREATE INDEX purchases_grp ON purchases (grp, seq)")
+
+    @staticmethod
+    def _estimate_size(purchase: Dict) -> int:
+        return sys.getsizeof(purchase) + sum(
+            sys.getsizeof(v) for v in purchase.values()
+        )
+
+    def append(self, customer_id: Any, purchase: Dict) -> None:
+        """
+        Add a purchase to a customer, spilling to disk if over the budget.
+        """
+        group = self._groups.setdefault(customer_id, len(self._groups))
+        size = self._estimate_size(purchase)
+        self._in_memory.setdefault(group, []).append(purchase)
+        self._group_sizes[group] = self._group_sizes.get(group, 0) + size
+        self.memory_used += size
+        if self.memory_used > self.max_memory:
+            self._spill()
+
+    def _spill(self) -> None:
+        """
+        Move the largest in-memory groups to disk until under half the budget.
+        """
+        target = self.max_memory // 2
+        largest_first = sorted(
+            self._group_sizes, key=self._group_sizes.__getitem__, reverse=True
+        )
+        for group in largest_first:
+            if self.memory_used <= target:
+                break
+            rows = []
+            for purchase in self._in_memory.pop(group):
+                rows.append((group, self._seq, json.dumps(purchase)))
+                self._seq += 1
+            self._db.executemany("INSERT INTO purchases VALUES (?, ?, ?)", rows)
+            self.memory_used -= self._group_sizes.pop(group)
+            if group not in self._on_disk:
+                self._on_disk.add(group)
+                self.spilled_groups += 1
+        self._db.commit()
+        logging.info(
+            f"Spilled purchases to disk: {self.spilled_groups} customers on disk"
+        )
+
+    def _read_spilled(self, group: int) -> Iterator[Dict]:
+        cursor = self._db.execute(
+            "SELECT data FROM purchases WHERE grp = ? ORDER BY seq", (group,)
+        )
+        for (data,) in cursor:
+            yield json.loads(data)
+
+    def __getitem__(self, customer_id: Any) -> List[Dict]:
+        group = self._groups[customer_id]
+        purchases: List[Dict] = []
+        if group in self._on_disk:
+            purchases.extend(self._read_spilled(group))
+        purchases.extend(self._in_memory.get(group, []))
+        return purchases
+
+    def __contains__(self, customer_id: Any) -> bool:
+        # Avoid reading spilled groups back from disk, as Mapping would do
+        return customer_id in self._groups
+
+    def __iter__(self) -> Iterator:
+        return iter(self._groups)
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def close(self) -> None:
+        """
+        Close the on-disk store and delete its temporary file.
+        """
+        self._db.close()
 
 
 class PurchaseCreator:
-    def __init__(self, purchases_file: str):
+    dedup_policies = ["last", "reject"]
+
+    def __init__(
+        self,
+        purchases_file: str,
+        max_memory: Optional[int] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        dedup: Optional[str] = None,
+        dedup_key: str = "purchase_identifier",
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        intern_strings: bool = True,
+    ):
+        if dedup is not None and dedup not in self.dedup_policies:
+            msg = f"Dedup policy {dedup} not supported. Please use one of {self.dedup_policies}."  # noqa: E501
+            logging.error(msg)
+            raise ValueError(msg)
         self.purchases_file: str = purchases_file
+        self.max_memory: Optional[int] = max_memory
+        self.shard: Optional[Tuple[int, int]] = shard
+        self.dedup: Optional[str] = dedup
+        self.dedup_key: str = dedup_key
+        self.since: Optional[str] = since
+        self.until: Optional[str] = until
+        self.intern_strings: bool = intern_strings
         self.bad_purchase_data: defaultdict = defaultdict(list)
-        self.puchases_per_customer: defaultdict = self.read_purchase_csv()
+        self.duplicate_purchase_data: defaultdict = defaultdict(list)
+        self.puchases_per_customer: Union[
+            defaultdict, SpillingPurchaseStore
+        ] = self.read_purchase_csv()
 
     def _format_purchase_data(
         self,
@@ -22,40 +389,182 @@ class PurchaseCreator:
     ) -> Dict[str, Union[str, int, float]]:
         """
         Format purchase data to the required format for the API.
+        Low cardinality strings are interned so rows share a single copy,
+        unless `intern_strings` is False.
         """
+        intern = sys.intern if self.intern_strings else str
         purchase_data: Dict[str, Union[str, int, float]] = {}
         for key, value in row.items():
             if key == "product_id":
-                purchase_data[key] = str(value)
+                purchase_data[key] = intern(str(value))
             if key == "price":
                 purchase_data[key] = float(value)
             elif key == "currency":
-                purchase_data[key] = str(value)
+                purchase_data[key] = intern(str(value))
             elif key == "quantity":
                 purchase_data[key] = int(value)
             elif key == "date":
-                purchase_data["purchased_at"] = str(value)
+                purchase_data["purchased_at"] = intern(str(value))
         return purchase_data
 
-    def read_purchase_csv(self) -> defaultdict:
+    def read_purchase_csv(self) -> Union[defaultdict, SpillingPurchaseStore]:
         """
         Read the purchase CSV file and return a defaultdict with `customer_id: list of purchases`.
+        If `max_memory` is set, return a `SpillingPurchaseStore` instead.
+        If `shard` is set, rows of customers in other shards are skipped.
+        If `dedup` is set, valid rows sharing the same `dedup_key` are kept once.
+        If `since` or `until` is set, only rows dated in the window are read.
+        A `SpillingPurchaseStore` of a previous read is closed.
         """
-        with open(self.purchases_file) as p:
-            purchases_list = list(csv.DictReader(p, delimiter=";"))
+        previous = getattr(self, "puchases_per_customer", None)
+        if isinstance(previous, SpillingPurchaseStore):
+            previous.close()
+
+        puchases_per_customer: Union[defaultdict, SpillingPurchaseStore]
+        if self.max_memory is None:
+            puchases_per_customer = defaultdict(list)
+        else:
+            puchases_per_customer = SpillingPurchaseStore(self.max_memory)
+
+        if self.dedup is not None:
+            self._check_dedup_key()
+        last_rows: Dict[Union[str, bytes], int] = {}
+        invalid_rows: set = set()
+        if self.dedup == "last":
+            last_rows, invalid_rows = self._index_last_valid_rows()
+        seen_keys: set = set()
 
-        puchases_per_customer: defaultdict = defaultdict(list)
-        for row in purchases_list:
+        # Stream rows so the whole file is never held in memory at once
+        for row_number, row in enumerate(self._read_rows()):
+            customer_id = row.get("customer_id")
+            # Invalid rows found while indexing are already reported
+            if not in_shard(customer_id, self.shard) or row_number in invalid_rows:
+                continue
             # Extract needed data for API payload
             purchase_data = self._format_purchase_data(row)
-            valid = self._validate_purchase_data(purchase_data)
-            if valid:
-                # Add purchase to the customer
-                puchases_per_customer[row.get("customer_id")].append(purchase_data)
+            # With `last`, rows were already validated while indexing
+            if self.dedup != "last" and not self._validate_purchase_data(
+                purchase_data
+            ):
+                self.bad_purchase_data[customer_id].append(row)
+                continue
+            # Only valid rows are deduplicated, so a bad copy never hides a good one
+            if self._is_duplicate(row, row_number, last_rows, seen_keys):
+                self.duplicate_purchase_data[customer_id].append(row)
+                continue
+            # Add purchase to the customer
+            if isinstance(puchases_per_customer, SpillingPurchaseStore):
+                puchases_per_customer.append(customer_id, purchase_data)
             else:
-                self.bad_purchase_data[row.get("customer_id")].append(row)
+                puchases_per_customer[customer_id].append(purchase_data)
+        self.puchases_per_customer = puchases_per_customer
         return puchases_per_customer
 
+    def _read_rows(self) -> Iterator[Dict[str, str]]:
+        """
+        Read the purchase CSV rows dated between `since` and `until` (included).
+        Dates are compared as `YYYY-MM-DD` strings, before any formatting. Rows
+        without a `YYYY-MM-DD` date cannot be placed in the window, so they are
+        always read and reported as bad data by the validation. If the file has
+        an up to date date index, only the slice of the window is read.
+        """
+        dates = None
+        if self.since is not None or self.until is not None:
+            dates = load_date_index(self.purchases_file)
+
+        with open(self.purchases_file, "rb") as raw:
+            fieldnames = next(
+                csv.reader([raw.readline().decode("utf-8")], delimiter=";")
+            )
+            if dates and self.since is not None:
+                # Seek to the first row dated on or after `since`
+                start = bisect.bisect_left([date for date, _ in dates], self.since)
+                if start == len(dates):
+                    return
+                raw.seek(dates[start][1])
+            p = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            for row in csv.DictReader(p, fieldnames=fieldnames, delimiter=";"):
+                date = row.get("date") or ""
+                if not DATE_PATTERN.match(date):
+                    yield row
+                    continue
+                if self.until is not None and date > self.until:
+                    if dates:
+                        # The file is sorted by date, no more rows in the window
+                        return
+                    continue
+                if self.since is not None and date < self.since:
+                    continue
+                yield row
+
+    def _index_last_valid_rows(
+        self,
+    ) -> Tuple[Dict[Union[str, bytes], int], set]:
+        """
+        Index the row number of the last valid occurrence of each dedup key.
+        Rows are validated here, so invalid ones are reported to
+        `bad_purchase_data` and their row numbers returned to be skipped.
+        """
+        last_rows: Dict[Union[str, bytes], int] = {}
+        invalid_rows: set = set()
+        for row_number, row in enumerate(self._read_rows()):
+            customer_id = row.get("customer_id")
+            if not in_shard(customer_id, self.shard):
+                continue
+            purchase_data = self._format_purchase_data(row)
+            if self._validate_purchase_data(purchase_data):
+                last_rows[self._dedup_key_of(row)] = row_number
+            else:
+                self.bad_purchase_data[customer_id].append(row)
+                invalid_rows.add(row_number)
+        return last_rows, invalid_rows
+
+    def _check_dedup_key(self) -> None:
+        """
+        Check that the `dedup_key` column is in the purchase CSV header.
+        """
+        with open(self.purchases_file, encoding="utf-8", newline="") as p:
+            fieldnames = next(csv.reader(p, delimiter=";"), [])
+        if self.dedup_key not in fieldnames:
+            msg = f"Dedup key {self.dedup_key} not found in the columns of {self.purchases_file}: {fieldnames}."  # noqa: E501
+            logging.error(msg)
+            raise ValueError(msg)
+
+    def _dedup_key_of(self, row: Dict) -> Union[str, bytes]:
+        """
+        Get the dedup key of a row: its `dedup_key` column, or a hash of the
+        whole row if the value of that column is empty, so exact duplicates
+        are found too.
+        """
+        key = row.get(self.dedup_key)
+        if key:
+            return key
+        return hashlib.blake2b(
+            repr(list(row.items())).encode("utf-8"), digest_size=16
+        ).digest()
+
+    def _is_duplicate(
+        self,
+        row: Dict,
+        row_number: int,
+        last_rows: Dict[Union[str, bytes], int],
+        seen_keys: set,
+    ) -> bool:
+        """
+        Check if a valid row is a duplicate to drop.
+        With `last`, all valid occurrences but the last one are dropped.
+        With `reject`, all valid occurrences but the first one are dropped.
+        """
+        if self.dedup is None:
+            return False
+        key = self._dedup_key_of(row)
+        if self.dedup == "last":
+            return last_rows[key] != row_number
+        if key in seen_keys:
+            return True
+        seen_keys.add(key)
+        return False
+
     def _validate_purchase_data(self, purchase: Dict) -> Union[Dict, None]:
         """
         Validate the purchase data against a schema.
@@ -91,7 +600,7 @@ class PurchaseCreator:
             )
         return None
 
-    def export_bad_data(self) -> None:
+    def export_bad_data(self, reports_dir: str = "reports") -> None:
         """
         Dump bad purchase data to a JSON file.
         """
@@ -99,7 +608,7 @@ class PurchaseCreator:
             self.bad_purchase_data
         )  # pragma: no cover
 
-        bad_file = "reports/bad_purchases.json"
+        bad_file = f"{reports_dir}/bad_purchases.json"
         with open(bad_file, "w") as json_file:
             json.dump(bad_purchase_data_dict, json_file)
         if len(bad_purchase_data_dict) > 0:
@@ -111,10 +620,22 @@ class PurchaseCreator:
                 f"No bad purchase data found // exported empty file to {bad_file}"
             )
 
+        n_duplicates = sum(len(rows) for rows in self.duplicate_purchase_data.values())
+        duplicate_file = f"{reports_dir}/duplicate_purchases.json"
+        with open(duplicate_file, "w") as json_file:
+            json.dump(dict(self.duplicate_purchase_data), json_file)
+        if n_duplicates > 0:
+            msg = f"n duplicate purchase entries dropped: {n_duplicates} // exported to {duplicate_file}"  # noqa: E501
+            logging.info(msg)
+            print(msg)
+
 
 class CustomerCreator:
-    def __init__(self, customers_file: str):
+    def __init__(
+        self, customers_file: str, shard: Optional[Tuple[int, int]] = None
+    ):
         self.customers_file: str = customers_file
+        self.shard: Optional[Tuple[int, int]] = shard
         self.salutation: dict = {"1": "Mme", "2": "M", None: "", "": ""}
         self.customer_dic: list = []
         self.bad_customer_data: defaultdict = defaultdict(list)
@@ -125,6 +646,7 @@ class CustomerCreator:
         """
 
         customer_data = {
+            # Taken from the lookup table so all customers share its strings
             "salutation": self.salutation[row.get("title", "")],
             "last_name": row.get("lastname", ""),
             "first_name": row.get("firstname", ""),
@@ -138,6 +660,7 @@ class CustomerCreator:
     def read_customer_csv(self) -> defaultdict:
         """
         Assume that the customer data is unique.
+        If `shard` is set, customers in other shards are skipped.
         """
         with open(self.customers_file) as c:
             customers_reader = csv.DictReader(c, delimiter=";")
@@ -145,6 +668,8 @@ class CustomerCreator:
 
         customer_data: defaultdict = defaultdict(dict)
         for customer in customers_list:
+            if not in_shard(customer.get("customer_id"), self.shard):
+                continue
             formatted_customer_data = self._format_customer_data(customer)
             valid_data = self._validate_customer_data(formatted_customer_data)
 
@@ -190,12 +715,12 @@ class CustomerCreator:
             )
         return None
 
-    def export_bad_data(self) -> None:
+    def export_bad_data(self, reports_dir: str = "reports") -> None:
         """
         Dump bad customer data to a JSON file.
         """
         bad_customers_data_dict = dict(self.bad_customer_data)
-        bad_file = "reports/bad_customers.json"
+        bad_file = f"{reports_dir}/bad_customers.json"
         with open(bad_file, "w") as json_file:
             json.dump(bad_customers_data_dict, json_file)
         if len(bad_customers_data_dict) > 0:
@@ -213,7 +738,8 @@ class CustomerCreator:
 class PayloadCreator:
     @staticmethod
     def get_payload(
-        customers_dic: defaultdict, purchases_per_customer: defaultdict
+        customers_dic: defaultdict,
+        purchases_per_customer: Union[defaultdict, SpillingPurchaseStore],
     ) -> List[Dict]:
         """
         Get the payload for the API.
@@ -222,17 +748,59 @@ class PayloadCreator:
         payload = []
         for customer_id in purchases_per_customer:
             final_dict = customers_dic[customer_id]
-            final_dict["purchases"] = [purchases_per_customer[customer_id]]
+            final_dict["purchases"] = purchases_per_customer[customer_id]
             payload.append(final_dict)
         return payload
 
+    @staticmethod
+    def get_encoded_payload(
+        customers_dic: defaultdict,
+        purchases_per_customer: Union[defaultdict, SpillingPurchaseStore],
+        encoder: JSONEncoderBackend,
+    ) -> Iterator[bytes]:
+        """
+        Get the payload for the API as JSON fragments, one per customer.
+        Each customer is encoded once when it is joined with its purchases,
+        and the fragments are built one at a time to join with `encoder.join`.
+        """
+        for customer_id in purchases_per_customer:
+            final_dict = dict(customers_dic[customer_id])
+            final_dict["purchases"] = purchases_per_customer[customer_id]
+            yield encoder.dumps(final_dict)
+
 
-def make_request(payload: List[Dict], env):
+def _save_chunks(chunks: Iterable[bytes], payload_file: str) -> Iterator[bytes]:
+    """
+    Write the chunks of a JSON body to a file as they are sent.
+    """
+    with open(payload_file, "wb") as json_file:
+        for chunk in chunks:
+            json_file.write(chunk)
+            yield chunk
+
+
+def make_request(
+    payload: Union[List[Dict], bytes, Iterator[bytes]],
+    env,
+    url: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+    save_payload: bool = True,
+    reports_dir: str = "reports",
+    timeout: Optional[float] = None,
+):
     """
     Send the payload to the API.
+    The payload is either a list of customers, an already encoded JSON body, or
+    an iterator of chunks of a JSON body, which is streamed to the API with a
+    chunked upload and to `payload.json` without ever being held in memory.
+    `url` overrides the endpoint of `env`, e.g. to target a local mock API, and
+    `session` reuses its connections across calls. `timeout` is the number of
+    seconds to wait for the API to connect or answer, None to wait forever.
     """
 
-    if env in ["dev", "test"]:
+    if url is not None:
+        logging.info(f"Using URL {url} instead of the {env} endpoint.")
+    elif env in ["dev", "test"]:
         url = f"https://{env}.myhostname.com/v1/customers/"
     elif env == "prod":
         url = "https://myhostname.com/v1/customers/"
@@ -241,12 +809,24 @@ def make_request(payload: List[Dict], env):
         logging.error(msg)
         raise ValueError(msg)
 
-    # Save JSON payload locally
-    with open("reports/payload.json", "w") as json_file:
-        json.dump(payload, json_file)
+    payload_file = f"{reports_dir}/payload.json"
+    data: Union[str, bytes, Iterator[bytes]]
+    if isinstance(payload, (bytes, list)):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload)
+        # Save JSON payload locally
+        if save_payload:
+            with open(
+                payload_file, "wb" if isinstance(data, bytes) else "w"
+            ) as json_file:
+                json_file.write(data)
+    else:
+        # Save JSON payload locally while it is sent
+        data = _save_chunks(payload, payload_file) if save_payload else payload
 
     headers = {"Content-Type": "application/json"}
-    response = requests.put(url, headers=headers, data=json.dumps(payload))
+    response = (session or requests).put(
+        url, headers=headers, data=data, timeout=timeout
+    )
 
     if response.status_code == 200:
         msg = "In-flight payment data sent successfully to the API."
@@ -259,7 +839,59 @@ def make_request(payload: List[Dict], env):
     return response.json()
 
 
-def run():
+def merge_shard_reports(n_shards: int, reports_dir: str = "reports") -> None:
+    """
+    Merge the reports of shards 0 to `n_shards - 1` into `reports_dir`.
+    Shards hold disjoint customers, so bad and duplicate data dicts are merged
+    by key and payloads are concatenated.
+    """
+    if not _valid_shard(0, n_shards):
+        msg = f"Number of shards {n_shards} not supported. Please use N >= 1."
+        logging.error(msg)
+        raise ValueError(msg)
+    payload: List[Dict] = []
+    bad_data: Dict[str, Dict] = {
+        "bad_purchases.json": {},
+        "bad_customers.json": {},
+        "duplicate_purchases.json": {},
+    }
+    for index in range(n_shards):
+        shard_dir = shard_reports_dir((index, n_shards))
+        if not os.path.exists(f"{shard_dir}/payload.json"):
+            msg = f"No report found for shard {index}/{n_shards} in {shard_dir}."
+            logging.error(msg)
+            raise FileNotFoundError(msg)
+        with open(f"{shard_dir}/payload.json") as json_file:
+            payload.extend(json.load(json_file))
+        for file_name, merged in bad_data.items():
+            if not os.path.exists(f"{shard_dir}/{file_name}"):
+                continue
+            with open(f"{shard_dir}/{file_name}") as json_file:
+                merged.update(json.load(json_file))
+
+    with open(f"{reports_dir}/payload.json", "w") as json_file:
+        json.dump(payload, json_file)
+    for file_name, merged in bad_data.items():
+        with open(f"{reports_dir}/{file_name}", "w") as json_file:
+            json.dump(merged, json_file)
+    msg = f"Merged reports of {n_shards} shards: {len(payload)} customers with purchases"  # noqa: E501
+    logging.info(msg)
+    print(msg)
+
+
+def run_merge_reports():
+    parser = argparse.ArgumentParser(
+        description="Merge the reports of a run split with --shard"
+    )
+    parser.add_argument(
+        "-n",
+        "--shards",
+        required=True,
+        type=parse_shard_count,
+        help="Number of shards N used with --shard i/N.",
+    )
+    args = parser.parse_args()
+
     if not os.path.exists("reports"):
         os.makedirs("reports")
 
@@ -269,6 +901,27 @@ def run():
         format="%(asctime)s - %(levelname)s - %(message)s",
     )
 
+    merge_shard_reports(args.shards)
+
+
+def run_build_date_index():
+    parser = argparse.ArgumentParser(
+        description="Build the date index used by --since/--until on a purchases "
+        "CSV file sorted by date"
+    )
+    parser.add_argument(
+        "-p",
+        "--purchases",
+        required=True,
+        type=str,
+        help="Path to a CSV file containing purchase data, sorted by date.",
+    )
+    args = parser.parse_args()
+    index_file = build_date_index(args.purchases)
+    print(f"Date index exported to {index_file}")
+
+
+def run():
     parser = argparse.ArgumentParser(description="Send CSV files to API")
     parser.add_argument(
         "-p",
@@ -293,9 +946,76 @@ def run():
         choices=["dev", "test", "prod"],
         help="Environment to use.",
     )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_positive_int,
+        default=None,
+        help="Memory budget in MB for grouped purchases. "
+        "Groups over the budget are spilled to a temporary file on disk. "
+        "The payload is always streamed to the API one customer at a time.",
+    )
+    parser.add_argument(
+        "--json-backend",
+        type=str,
+        default="auto",
+        choices=JSONEncoderBackend.backends,
+        help="JSON encoder to use. 'auto' uses orjson if it is installed.",
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=None,
+        help="Send to this URL instead of the endpoint of --env, "
+        "e.g. a local mock API started with inflightpayment-mockapi.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only process customers of shard i out of N, given as i/N with "
+        "0 <= i < N. Reports are saved in reports/shard_i_of_N.",
+    )
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        choices=PurchaseCreator.dedup_policies,
+        help="Drop valid purchases with the same --dedup-key, or the same whole "
+        "row if the key is empty: 'last' keeps the last one, 'reject' keeps the "
+        "first one. 'last' reads the purchases file twice. Dropped rows are "
+        "saved in duplicate_purchases.json.",
+    )
+    parser.add_argument(
+        "--dedup-key",
+        type=str,
+        default="purchase_identifier",
+        help="Purchase CSV column identifying a purchase for --dedup.",
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_date,
+        default=None,
+        help="Only send purchases dated on or after this date (YYYY-MM-DD).",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_date,
+        default=None,
+        help="Only send purchases dated on or before this date (YYYY-MM-DD).",
+    )
 
     args = parser.parse_args()
 
+    reports_dir = shard_reports_dir(args.shard)
+    if not os.path.exists(reports_dir):
+        os.makedirs(reports_dir)
+
+    logging.basicConfig(
+        filename=f"{reports_dir}/cli_paymentdata.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
     logging.info(f"# --- Starting the script with arguments: {args} --- #")
 
     if not args.purchases or not args.customers:
@@ -306,6 +1026,12 @@ def run():
         logging.warning(msg_files)
         return None
 
+    if args.since is not None and args.until is not None and args.since > args.until:
+        msg_dates = f"--since {args.since} is after --until {args.until}."
+        print(msg_dates)
+        logging.warning(msg_dates)
+        return None
+
     if not args.purchases.endswith(".csv"):
         msg_p = "Please provide a valid path to a CSV file containing purchase data."
         print(msg_p)
@@ -318,22 +1044,46 @@ def run():
             logging.warning(msg_c)
         return None
 
-    purchases = PurchaseCreator(args.purchases)
-    purchases_per_customer = purchases.read_purchase_csv()
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 1024 * 1024
+    purchases = PurchaseCreator(
+        args.purchases,
+        max_memory=max_memory,
+        shard=args.shard,
+        dedup=args.dedup,
+        dedup_key=args.dedup_key,
+        since=args.since,
+        until=args.until,
+    )
+    purchases_per_customer = purchases.puchases_per_customer
 
-    customers = CustomerCreator(args.customers)
-    customers_dic = customers.read_customer_csv()
+    try:
+        customers = CustomerCreator(args.customers, shard=args.shard)
+        customers_dic = customers.read_customer_csv()
 
-    payload = PayloadCreator().get_payload(customers_dic, purchases_per_customer)
+        encoder = JSONEncoderBackend(args.json_backend)
+        # Customers are read back, encoded and sent one at a time
+        fragments = PayloadCreator().get_encoded_payload(
+            customers_dic, purchases_per_customer, encoder
+        )
 
-    msg = f"Sending payload to the API: {len(payload)} customers with purchases"  # noqa: E501
-    logging.info(msg)
-    print(msg)
+        msg = f"Sending payload to the API: {len(purchases_per_customer)} customers with purchases"  # noqa: E501
+        logging.info(msg)
+        print(msg)
 
-    make_request(payload, args.env)
+        make_request(
+            encoder.iter_join(fragments),
+            args.env,
+            url=args.url,
+            reports_dir=reports_dir,
+        )
+    finally:
+        if isinstance(purchases_per_customer, SpillingPurchaseStore):
+            purchases_per_customer.close()
 
-    purchases.export_bad_data()
-    customers.export_bad_data()
+    purchases.export_bad_data(reports_dir)
+    customers.export_bad_data(reports_dir)
 
 
 if __name__ == "__main__":
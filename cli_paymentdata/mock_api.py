@@ -0,0 +1,471 @@
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple, Union
+
+from cli_paymentdata.cli_read_csv import (
+    CustomerCreator,
+    JSONEncoderBackend,
+    PayloadCreator,
+    PurchaseCreator,
+    make_request,
+    parse_positive_int,
+)
+
+
+class MockCustomersHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive
+    protocol_version = "HTTP/1.1"
+    server: "MockCustomersAPI"
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _send_json(self, status: int, body: Dict, headers: Optional[Dict] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, headers: Optional[Dict] = None):
+        self._send_json(
+            status, {"status": "error", "data": None, "message": message}, headers
+        )
+
+    def _read_body(self) -> Optional[bytes]:
+        """
+        Read the request body, sent with a Content-Length or chunked.
+        Return None if it is over `max_body_size`; the body is still drained
+        so the client gets the answer.
+        """
+        max_body_size = self.server.max_body_size
+        chunks: List[bytes] = []
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0], 16)
+                if chunk_size == 0:
+                    # Skip trailers up to the empty line ending the body
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunk = self.rfile.read(chunk_size)
+                self.rfile.readline()
+                size += chunk_size
+                if max_body_size is None or size <= max_body_size:
+                    chunks.append(chunk)
+        else:
+            length = int(self.headers.get("Content-Length", 0))
+            while size < length:
+                chunk = self.rfile.read(min(length - size, 64 * 1024))
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_body_size is None or length <= max_body_size:
+                    chunks.append(chunk)
+        if max_body_size is not None and size > max_body_size:
+            return None
+        return b"".join(chunks)
+
+    def do_PUT(self) -> None:
+        """
+        Mimic `PUT /v1/customers/` of the customers API.
+        """
+        with self.server.lock:
+            self.server.requests += 1
+
+        body = self._read_body()
+        if body is None:
+            return self._send_error(
+                413, f"Body over {self.server.max_body_size} bytes"
+            )
+        if self.path != self.server.path:
+            return self._send_error(404, f"Unknown path {self.path}")
+
+        if self.server.throttled():
+            return self._send_error(429, "Too many requests", {"Retry-After": "1"})
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failed():
+            return self._send_error(500, "Internal server error")
+
+        try:
+            customers = json.loads(body)
+        except ValueError:
+            return self._send_error(400, "Body is not valid JSON")
+        if not isinstance(customers, list):
+            return self._send_error(400, "Body is not a JSON list of customers")
+        self._send_json(
+            200,
+            {"status": "success", "data": {"customers": len(customers)}, "message": None},
+        )
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"Mock API: {format % args}")
+
+
+class MockCustomersAPI(ThreadingHTTPServer):
+    """
+    Local stand-in for the customers API.
+
+    - `latency`: seconds to wait before answering a request.
+    - `error_rate`: share of requests answered with a 500 error.
+    - `max_requests_per_second`: requests over this rate get a 429 error.
+    - `max_body_size`: bodies over this size in bytes get a 413 error.
+    """
+
+    daemon_threads = True
+    path = "/v1/customers/"
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        max_requests_per_second: Optional[int] = None,
+        max_body_size: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        super().__init__((host, port), MockCustomersHandler)
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.max_requests_per_second: Optional[int] = max_requests_per_second
+        self.max_body_size: Optional[int] = max_body_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests: int = 0
+        self.connections: int = 0
+        self._window_start: float = time.monotonic()
+        self._window_requests: int = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def throttled(self) -> bool:
+        """
+        Count the request in the current one second window.
+        """
+        if self.max_requests_per_second is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            return self._window_requests > self.max_requests_per_second
+
+    def failed(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def start(self) -> threading.Thread:
+        """
+        Serve in a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def load_test(
+    purchases_file: str,
+    customers_file: str,
+    url: str,
+    n_requests: int = 100,
+    concurrency: int = 4,
+    json_backend: str = "auto",
+    timeout: Optional[float] = 30.0,
+) -> Dict[str, Union[int, float]]:
+    """
+    Run the inflightpayment pipeline once and upload its payload `n_requests` times.
+    Each worker thread reuses its connections through a `requests.Session`.
+    Uploads taking longer than `timeout` seconds fail as timeouts.
+    Latency percentiles cover all requests, `success_*` ones only the
+    successful requests.
+    """
+    start = time.perf_counter()
+    purchases = PurchaseCreator(purchases_file)
+    customers = CustomerCreator(customers_file)
+    encoder = JSONEncoderBackend(json_backend)
+    fragments = list(
+        PayloadCreator.get_encoded_payload(
+            customers.read_customer_csv(), purchases.puchases_per_customer, encoder
+        )
+    )
+    body = encoder.join(fragments)
+    pipeline_seconds = time.perf_counter() - start
+
+    sessions = threading.local()
+    all_sessions: List[requests.Session] = []
+    sessions_lock = threading.Lock()
+
+    def send() -> Tuple[float, bool, bool]:
+        """
+        Upload the payload once and return its latency, whether it succeeded
+        and whether it timed out.
+        """
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+            with sessions_lock:
+                all_sessions.append(sessions.session)
+        sent = time.perf_counter()
+        timed_out = False
+        try:
+            response = make_request(
+                body,
+                "dev",
+                url=url,
+                session=sessions.session,
+                save_payload=False,
+                timeout=timeout,
+            )
+            success = response.get("status") == "success"
+        except requests.Timeout as e:
+            logging.error(f"Load test request timed out: {e}")
+            success = False
+            timed_out = True
+        except (requests.RequestException, ValueError) as e:
+            logging.error(f"Load test request failed: {e}")
+            success = False
+        return time.perf_counter() - sent, success, timed_out
+
+    start = time.perf_counter()
+    try:
+        # make_request prints one line per call, keep the report readable
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(lambda _: send(), range(n_requests)))
+    finally:
+        for session in all_sessions:
+            session.close()
+    upload_seconds = time.perf_counter() - start
+
+    # Failed requests are kept in the overall latencies, as slow or failing
+    # requests are what the tail latency should show
+    latencies = sorted(latency for latency, _, _ in results)
+    ok = sorted(latency for latency, success, _ in results if success)
+    failed = n_requests - len(ok)
+    return {
+        "customers": len(fragments),
+        "body_bytes": len(body),
+        "requests": n_requests,
+        "failed_requests": failed,
+        "timed_out_requests": sum(timed_out for _, _, timed_out in results),
+        "error_rate": failed / n_requests if n_requests else 0.0,
+        "pipeline_seconds": pipeline_seconds,
+        "upload_seconds": upload_seconds,
+        "requests_per_second": n_requests / upload_seconds,
+        "megabytes_per_second": len(body) * n_requests / upload_seconds / 1024**2,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "success_p50_ms": _percentile(ok, 50) * 1000,
+        "success_p95_ms": _percentile(ok, 95) * 1000,
+        "success_p99_ms": _percentile(ok, 99) * 1000,
+    }
+
+
+def _parse_timeout(value: str) -> float:
+    """
+    Parse a timeout in seconds, over 0.
+    """
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = 0.0
+    if not timeout > 0:
+        raise argparse.ArgumentTypeError(
+            f"Timeout {value} not supported. Please use a number of seconds > 0."
+        )
+    return timeout
+
+
+def _add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the mock API waits before answering.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests (0 to 1) answered with a 500 error.",
+    )
+    parser.add_argument(
+        "--max-rps",
+        type=int,
+        default=None,
+        help="Requests per second over which the mock API answers 429.",
+    )
+    parser.add_argument(
+        "--max-body-size",
+        type=int,
+        default=None,
+        help="Body size in bytes over which the mock API answers 413.",
+    )
+
+
+def run_server():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Run a local mock customers API")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind.")
+    _add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockCustomersAPI(
+        args.host,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        max_requests_per_second=args.max_rps,
+        max_body_size=args.max_body_size,
+    )
+    print(f"Mock customers API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_load_test():
+    if not os.path.exists("reports"):
+        os.makedirs("reports")
+
+    logging.basicConfig(
+        filename="reports/load_test.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Load test the inflightpayment upload against a mock API"
+    )
+    parser.add_argument(
+        "-p",
+        "--purchases",
+        required=True,
+        type=str,
+        help="Path to a CSV file containing purchase data.",
+    )
+    parser.add_argument(
+        "-c",
+        "--customers",
+        required=True,
+        type=str,
+        help="Path to a CSV file containing customer data.",
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=None,
+        help="URL of a running API. By default a local mock API is started.",
+    )
+    parser.add_argument(
+        "-n",
+        "--requests",
+        type=parse_positive_int,
+        default=100,
+        help="Number of uploads.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=parse_positive_int,
+        default=4,
+        help="Number of parallel uploads.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=_parse_timeout,
+        default=30.0,
+        help="Seconds to wait for each upload before counting it as failed.",
+    )
+    parser.add_argument(
+        "--json-backend",
+        type=str,
+        default="auto",
+        choices=JSONEncoderBackend.backends,
+        help="JSON encoder to use. 'auto' uses orjson if it is installed.",
+    )
+    _add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = MockCustomersAPI(
+            latency=args.latency,
+            error_rate=args.error_rate,
+            max_requests_per_second=args.max_rps,
+            max_body_size=args.max_body_size,
+        )
+        server.start()
+        url = server.url
+
+    try:
+        report = load_test(
+            args.purchases,
+            args.customers,
+            url,
+            n_requests=args.requests,
+            concurrency=args.concurrency,
+            json_backend=args.json_backend,
+            timeout=args.timeout,
+        )
+    finally:
+        if server is not None:
+            server.stop()
+
+    if server is not None:
+        report["connections"] = server.connections
+
+    with open("reports/load_test.json", "w") as json_file:
+        json.dump(report, json_file)
+    logging.info(f"Load test report: {report}")
+    for key, value in report.items():
+        print(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    run_load_test()
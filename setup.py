@@ -14,9 +14,16 @@ setup(
         "requests",
         "requests-mock",
     ],
+    extras_require={
+        "fast": ["orjson"],
+    },
     entry_points={
         "console_scripts": [
             "inflightpayment=cli_paymentdata.cli_read_csv:run",
+            "inflightpayment-dateindex=cli_paymentdata.cli_read_csv:run_build_date_index",  # noqa: E501
+            "inflightpayment-mergereports=cli_paymentdata.cli_read_csv:run_merge_reports",  # noqa: E501
+            "inflightpayment-mockapi=cli_paymentdata.mock_api:run_server",
+            "inflightpayment-loadtest=cli_paymentdata.mock_api:run_load_test",
         ],
     },
 )
@@ -1,4 +1,5 @@
 import argparse
+import csv
 import pytest
 import tempfile
 
@@ -32,6 +33,82 @@ def example_purchases_csv_bad():
     return purchases_file
 
 
+@pytest.fixture(scope="session")
+def purchases_csv_many():
+    # Several customers with interleaved purchases
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as purchases_file:
+        purchases_file.write(
+            b"purchase_identifier;customer_id;product_id;quantity;price;currency;date\n"
+            b"2/01;2;1221;1;10;EUR;2017-12-31\n"
+            b"1/01;1;4324;1;10;EUR;2030-12-31\n"
+            b"3/01;3;75672;1;10;USD;2050-12-31\n"
+            b"2/02;2;3213;1;10;EUR;2030-12-31\n"
+            b"3/02;3;2123;2;10;EUR;2017-08-01\n"
+            b"5/01;5;5678;1;10;AUD;2022-01-01\n"
+            b"2/03;2;1222;3;20;GBP;2018-01-01\n"
+            b"1/02;1;4325;1;15;USD;2031-01-01"
+        )
+    return purchases_file
+
+
+@pytest.fixture(scope="session")
+def purchases_csv_duplicates():
+    # 2/01 is an exact duplicate, 1/01 is re-sent with a new quantity
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as purchases_file:
+        purchases_file.write(
+            b"purchase_identifier;customer_id;product_id;quantity;price;currency;date\n"
+            b"2/01;2;1221;1;10;EUR;2017-12-31\n"
+            b"1/01;1;4324;1;10;EUR;2030-12-31\n"
+            b"2/01;2;1221;1;10;EUR;2017-12-31\n"
+            b"2/02;2;3213;1;10;EUR;2030-12-31\n"
+            b"1/01;1;4324;2;10;EUR;2030-12-31\n"
+            b";3;75672;1;10;USD;2050-12-31\n"
+            b";3;75672;1;10;USD;2050-12-31"
+        )
+    return purchases_file
+
+
+@pytest.fixture(scope="session")
+def purchases_csv_large():
+    # Many rows sharing a few products, currencies and dates
+    rows = [b"purchase_identifier;customer_id;product_id;quantity;price;currency;date"]
+    for i in range(100):
+        rows.append(
+            b"%d/01;%d;%d;1;10;%s;2023-01-%02d"
+            % (i, i % 10, 1000 + i % 20, [b"EUR", b"USD", b"GBP"][i % 3], 1 + i % 28)
+        )
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as purchases_file:
+        purchases_file.write(b"\n".join(rows))
+    return purchases_file
+
+
+@pytest.fixture
+def purchases_csv_sorted(tmp_path):
+    # Sorted by date, in its own directory for the sidecar date index
+    rows = ["purchase_identifier;customer_id;product_id;quantity;price;currency;date"]
+    for day in range(1, 11):
+        for i in range(3):
+            rows.append(f"{day}/0{i};{i};{day}00{i};1;10;EUR;2023-01-{day:02d}")
+    purchases_file = tmp_path / "purchases.csv"
+    purchases_file.write_text("\n".join(rows))
+    return str(purchases_file)
+
+
+@pytest.fixture
+def count_read_rows(monkeypatch):
+    # List of the rows read from CSV files with csv.DictReader
+    read_rows = []
+
+    class CountingDictReader(csv.DictReader):
+        def __next__(self):
+            row = super().__next__()
+            read_rows.append(row)
+            return row
+
+    monkeypatch.setattr(csv, "DictReader", CountingDictReader)
+    return read_rows
+
+
 @pytest.fixture(scope="session")
 def pc(purchase_csv):
     return PurchaseCreator(purchase_csv.name)
@@ -219,22 +296,20 @@ def payload_example():
             "first_name": "Marie",
             "email": "marie-galante@france.fr",
             "purchases": [
-                [
-                    {
-                        "product_id": "1221",
-                        "quantity": 1,
-                        "price": 10.0,
-                        "currency": "EUR",
-                        "purchased_at": "2017-12-31",
-                    },
-                    {
-                        "product_id": "3213",
-                        "quantity": 1,
-                        "price": 10.0,
-                        "currency": "EUR",
-                        "purchased_at": "2030-12-31",
-                    },
-                ]
+                {
+                    "product_id": "1221",
+                    "quantity": 1,
+                    "price": 10.0,
+                    "currency": "EUR",
+                    "purchased_at": "2017-12-31",
+                },
+                {
+                    "product_id": "3213",
+                    "quantity": 1,
+                    "price": 10.0,
+                    "currency": "EUR",
+                    "purchased_at": "2030-12-31",
+                },
             ],
         },
         {
@@ -243,15 +318,13 @@ def payload_example():
             "first_name": "Chuck",
             "email": "chuck@norris.com",
             "purchases": [
-                [
-                    {
-                        "product_id": "4324",
-                        "quantity": 1,
-                        "price": 10.0,
-                        "currency": "EUR",
-                        "purchased_at": "2030-12-31",
-                    }
-                ]
+                {
+                    "product_id": "4324",
+                    "quantity": 1,
+                    "price": 10.0,
+                    "currency": "EUR",
+                    "purchased_at": "2030-12-31",
+                }
             ],
         },
         {
@@ -260,22 +333,20 @@ def payload_example():
             "first_name": "Christophe",
             "email": "christophe@fake.email",
             "purchases": [
-                [
-                    {
-                        "product_id": "75672",
-                        "quantity": 1,
-                        "price": 10.0,
-                        "currency": "USD",
-                        "purchased_at": "2050-12-31",
-                    },
-                    {
-                        "product_id": "2123",
-                        "quantity": 1,
-                        "price": 10.0,
-                        "currency": "EUR",
-                        "purchased_at": "2017-08-01",
-                    },
-                ]
+                {
+                    "product_id": "75672",
+                    "quantity": 1,
+                    "price": 10.0,
+                    "currency": "USD",
+                    "purchased_at": "2050-12-31",
+                },
+                {
+                    "product_id": "2123",
+                    "quantity": 1,
+                    "price": 10.0,
+                    "currency": "EUR",
+                    "purchased_at": "2017-08-01",
+                },
             ],
         },
     ]
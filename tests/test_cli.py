@@ -1,14 +1,33 @@
+import argparse
+import json
 import jsonschema
+import os
 import pytest
+import requests
+import sqlite3
+import sys
 
 from collections import defaultdict
 from requests_mock import Mocker
 
 from cli_paymentdata.cli_read_csv import (
     CustomerCreator,
+    JSONEncoderBackend,
     PurchaseCreator,
     PayloadCreator,
+    SpillingPurchaseStore,
+    build_date_index,
+    date_index_path,
+    in_shard,
+    load_date_index,
     make_request,
+    merge_shard_reports,
+    parse_date,
+    parse_positive_int,
+    parse_shard,
+    parse_shard_count,
+    run,
+    run_merge_reports,
 )
 
 # ----------------------------------- #
@@ -55,6 +74,322 @@ def test_read_purchase_csv_bad_purchase_data(example_purchases_csv_bad):
         raise jsonschema.ValidationError("Schema validation error")
 
 
+def test_read_purchase_csv_max_memory(purchases_csv_many):
+    in_memory = PurchaseCreator(purchases_csv_many.name).puchases_per_customer
+    # A tiny budget forces every group to be spilled to disk
+    spilling = PurchaseCreator(purchases_csv_many.name, max_memory=1)
+    result = spilling.puchases_per_customer
+
+    assert isinstance(result, SpillingPurchaseStore)
+    assert result.spilled_groups == len(in_memory)
+    assert list(result) == list(in_memory)
+    assert {k: result[k] for k in result} == dict(in_memory)
+    assert spilling.bad_purchase_data.keys() == {"5"}
+    result.close()
+
+
+def test_spilling_purchase_store_keeps_order():
+    store = SpillingPurchaseStore(max_memory=10**9)
+    store.append("1", {"product_id": "a"})
+    store.max_memory = 0
+    store.append("1", {"product_id": "b"})
+    store.max_memory = 10**9
+    store.append("1", {"product_id": "c"})
+    store.append(None, {"product_id": "d"})
+
+    assert store["1"] == [{"product_id": "a"}, {"product_id": "b"}, {"product_id": "c"}]
+    assert store[None] == [{"product_id": "d"}]
+    assert len(store) == 2
+    store.close()
+
+
+def test_read_purchase_csv_interns_strings(purchases_csv_large):
+    result = PurchaseCreator(purchases_csv_large.name).puchases_per_customer
+    purchases = [purchase for group in result.values() for purchase in group]
+    for key in ["product_id", "currency", "purchased_at"]:
+        distinct_values = {purchase[key] for purchase in purchases}
+        distinct_objects = {id(purchase[key]) for purchase in purchases}
+        assert len(distinct_objects) == len(distinct_values)
+
+
+def _retained_memory(purchases_file, intern_strings):
+    # Size of the grouped purchases, counting shared objects once
+    result = PurchaseCreator(
+        purchases_file, intern_strings=intern_strings
+    ).puchases_per_customer
+    seen = set()
+    to_visit = [result]
+    retained = 0
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        retained += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            to_visit.extend(obj.keys())
+            to_visit.extend(obj.values())
+        elif isinstance(obj, list):
+            to_visit.extend(obj)
+    return retained
+
+
+@pytest.mark.benchmark
+def test_read_purchase_csv_memory(purchases_csv_large):
+    interned = _retained_memory(purchases_csv_large.name, intern_strings=True)
+    not_interned = _retained_memory(purchases_csv_large.name, intern_strings=False)
+    assert interned < 0.8 * not_interned
+
+
+def test_read_purchase_csv_dedup_last(purchases_csv_duplicates):
+    pc_dedup = PurchaseCreator(purchases_csv_duplicates.name, dedup="last")
+    result = pc_dedup.puchases_per_customer
+    assert [p["product_id"] for p in result["2"]] == ["1221", "3213"]
+    assert [p["quantity"] for p in result["1"]] == [2]
+    # Exact duplicates without an identifier are found by the whole row
+    assert len(result["3"]) == 1
+    assert len(pc_dedup.duplicate_purchase_data["2"]) == 1
+    assert len(pc_dedup.duplicate_purchase_data["3"]) == 1
+    assert pc_dedup.duplicate_purchase_data["1"][0]["quantity"] == "1"
+
+
+def test_read_purchase_csv_dedup_reject(purchases_csv_duplicates):
+    pc_dedup = PurchaseCreator(purchases_csv_duplicates.name, dedup="reject")
+    result = pc_dedup.puchases_per_customer
+    assert [p["product_id"] for p in result["2"]] == ["1221", "3213"]
+    assert [p["quantity"] for p in result["1"]] == [1]
+    assert pc_dedup.duplicate_purchase_data["1"][0]["quantity"] == "2"
+
+
+@pytest.mark.parametrize(
+    "dedup, rows",
+    [
+        # The last copy is invalid, the valid one before it is kept
+        (
+            "last",
+            ["1/01;1;4324;1;10;EUR;2030-12-31", "1/01;1;4324;2;10;AUD;2030-12-31"],
+        ),
+        # The first copy is invalid, the valid one after it is kept
+        (
+            "reject",
+            ["1/01;1;4324;2;10;AUD;2030-12-31", "1/01;1;4324;1;10;EUR;2030-12-31"],
+        ),
+    ],
+)
+def test_read_purchase_csv_dedup_bad_copy(tmp_path, dedup, rows):
+    purchases_file = tmp_path / "purchases.csv"
+    purchases_file.write_text(
+        "\n".join(
+            ["purchase_identifier;customer_id;product_id;quantity;price;currency;date"]
+            + rows
+        )
+    )
+    pc_dedup = PurchaseCreator(str(purchases_file), dedup=dedup)
+    assert [p["currency"] for p in pc_dedup.puchases_per_customer["1"]] == ["EUR"]
+    assert [r["currency"] for r in pc_dedup.bad_purchase_data["1"]] == ["AUD"]
+    assert len(pc_dedup.duplicate_purchase_data) == 0
+
+
+def test_read_purchase_csv_dedup_key(purchases_csv_duplicates):
+    pc_dedup = PurchaseCreator(
+        purchases_csv_duplicates.name, dedup="reject", dedup_key="product_id"
+    )
+    result = pc_dedup.puchases_per_customer
+    assert len(result["3"]) == 1
+    assert sum(len(rows) for rows in pc_dedup.duplicate_purchase_data.values()) == 3
+
+
+def test_read_purchase_csv_dedup_key_not_found(purchases_csv_duplicates):
+    with pytest.raises(ValueError):
+        PurchaseCreator(
+            purchases_csv_duplicates.name, dedup="last", dedup_key="purchase_id"
+        )
+
+
+def test_read_purchase_csv_no_dedup(purchases_csv_duplicates):
+    pc_all = PurchaseCreator(purchases_csv_duplicates.name)
+    assert sum(len(group) for group in pc_all.puchases_per_customer.values()) == 7
+    assert len(pc_all.duplicate_purchase_data) == 0
+
+
+def test_purchase_creator_dedup_not_supported(purchases_csv_duplicates):
+    with pytest.raises(ValueError):
+        PurchaseCreator(purchases_csv_duplicates.name, dedup="first")
+
+
+def test_parse_date():
+    assert parse_date("2023-01-05") == "2023-01-05"
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_date("05/01/2023")
+
+
+def test_read_purchase_csv_date_window(purchases_csv_many):
+    pc_window = PurchaseCreator(
+        purchases_csv_many.name, since="2023-01-01", until="2030-12-31"
+    )
+    result = pc_window.puchases_per_customer
+    dates = [p["purchased_at"] for group in result.values() for p in group]
+    assert dates == ["2030-12-31", "2030-12-31"]
+    # The bad row dated 2022-01-01 is out of the window, so never validated
+    assert len(pc_window.bad_purchase_data) == 0
+
+
+@pytest.mark.parametrize(
+    "window", [{"since": "2000-01-01"}, {"until": "2023-01-01"}, {}]
+)
+def test_read_purchase_csv_date_window_bad_date(tmp_path, window):
+    purchases_file = tmp_path / "purchases.csv"
+    purchases_file.write_text(
+        "purchase_identifier;customer_id;product_id;quantity;price;currency;date\n"
+        "1/01;1;4324;1;10;EUR;31/12/2017\n"
+        "2/01;2;1221;1;10;EUR;"
+    )
+    # Rows without a YYYY-MM-DD date are reported whatever the window
+    pc_window = PurchaseCreator(str(purchases_file), **window)
+    assert pc_window.bad_purchase_data.keys() == {"1", "2"}
+    assert len(pc_window.puchases_per_customer) == 0
+
+
+def test_run_since_after_until(capfd, monkeypatch, purchases_csv_many):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "inflightpayment",
+            "-p",
+            purchases_csv_many.name,
+            "-c",
+            purchases_csv_many.name,
+            "--since",
+            "2023-01-05",
+            "--until",
+            "2023-01-04",
+        ],
+    )
+    assert run() is None
+    out, err = capfd.readouterr()
+    assert "is after --until" in out
+
+
+def test_build_date_index(purchases_csv_sorted):
+    index_file = build_date_index(purchases_csv_sorted)
+    assert index_file == date_index_path(purchases_csv_sorted)
+    with open(index_file) as json_file:
+        dates = json.load(json_file)["dates"]
+    assert [date for date, _ in dates] == [f"2023-01-{d:02d}" for d in range(1, 11)]
+    with open(purchases_csv_sorted, "rb") as p:
+        for date, offset in dates:
+            p.seek(offset)
+            assert p.readline().decode().strip().endswith(date)
+
+
+def test_build_date_index_not_sorted(purchases_csv_many):
+    with pytest.raises(ValueError):
+        build_date_index(purchases_csv_many.name)
+
+
+def test_build_date_index_bad_date(purchases_csv_sorted):
+    with open(purchases_csv_sorted, "a") as p:
+        p.write("\n11/00;0;11000;1;10;EUR;31/12/2023")
+    with pytest.raises(ValueError):
+        build_date_index(purchases_csv_sorted)
+
+
+@pytest.mark.parametrize(
+    "index", ['{"size": 1', '{"foo": 1}', '{"size": 1, "mtime_ns": 1, "dates": 3}']
+)
+def test_load_date_index_not_valid(purchases_csv_sorted, index):
+    with open(date_index_path(purchases_csv_sorted), "w") as json_file:
+        json_file.write(index)
+    assert load_date_index(purchases_csv_sorted) is None
+    result = PurchaseCreator(
+        purchases_csv_sorted, since="2023-01-04", until="2023-01-04"
+    ).puchases_per_customer
+    assert sum(len(group) for group in result.values()) == 3
+
+
+def test_read_purchase_csv_date_index(count_read_rows, purchases_csv_sorted):
+    kwargs = {"since": "2023-01-04", "until": "2023-01-05"}
+    expected = dict(PurchaseCreator(purchases_csv_sorted, **kwargs).puchases_per_customer)
+    build_date_index(purchases_csv_sorted)
+
+    count_read_rows.clear()
+    result = PurchaseCreator(purchases_csv_sorted, **kwargs).puchases_per_customer
+    assert dict(result) == expected
+    assert sum(len(group) for group in result.values()) == 6
+    # Only the window and the first row after it are read
+    assert len(count_read_rows) == 7
+
+
+def test_read_purchase_csv_date_index_out_of_date(
+    count_read_rows, purchases_csv_sorted
+):
+    build_date_index(purchases_csv_sorted)
+    with open(purchases_csv_sorted, "a") as p:
+        p.write("\n11/00;0;11000;1;10;EUR;2023-01-04")
+
+    result = PurchaseCreator(
+        purchases_csv_sorted, since="2023-01-04", until="2023-01-04"
+    ).puchases_per_customer
+    assert sum(len(group) for group in result.values()) == 4
+    assert len(count_read_rows) == 31
+
+
+def test_read_purchase_csv_twice_closes_spilling_store(purchases_csv_many):
+    spilling = PurchaseCreator(purchases_csv_many.name, max_memory=1)
+    first = spilling.puchases_per_customer
+    second = spilling.read_purchase_csv()
+    assert spilling.puchases_per_customer is second
+    with pytest.raises(sqlite3.ProgrammingError):
+        first._db.execute("SELECT 1")
+    expected = PurchaseCreator(purchases_csv_many.name).puchases_per_customer
+    assert dict(second) == dict(expected)
+    second.close()
+
+
+def test_spilling_purchase_store_contains_does_not_read_disk():
+    store = SpillingPurchaseStore(max_memory=0)
+    store.append("1", {"product_id": "a"})
+    store._read_spilled = None  # Any read from disk would fail
+    assert "1" in store
+    assert "2" not in store
+    store.close()
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "a"])
+def test_parse_positive_int_bad(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_positive_int(value)
+
+
+def test_run_closes_spilling_store_on_error(
+    monkeypatch, purchases_csv_many, customer_csv_path
+):
+    closed = []
+    monkeypatch.setattr(SpillingPurchaseStore, "close", lambda self: closed.append(1))
+
+    def failing_request(*args, **kwargs):
+        raise requests.ConnectionError("API down")
+
+    monkeypatch.setattr("cli_paymentdata.cli_read_csv.make_request", failing_request)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "inflightpayment",
+            "-p",
+            purchases_csv_many.name,
+            "-c",
+            customer_csv_path.name,
+            "--max-memory",
+            "1",
+        ],
+    )
+    with pytest.raises(requests.ConnectionError):
+        run()
+    assert closed == [1]
+
+
 def test_validate_purchase_data(pc, example_purchases_csv_row_formatted):
     result = pc._validate_purchase_data(example_purchases_csv_row_formatted)
     assert result == example_purchases_csv_row_formatted
@@ -118,6 +453,177 @@ def test_get_payload(example_customers_dic, example_purchases_per_customer_dic,
     print(example_purchases_per_customer_dic)
     assert result == payload_example
 
+def test_get_payload_encoded_json_byte_identical(
+    example_customers_dic, example_purchases_per_customer_dic, payload_example
+):
+    encoder = JSONEncoderBackend("json")
+    fragments = list(
+        PayloadCreator.get_encoded_payload(
+            example_customers_dic, example_purchases_per_customer_dic, encoder
+        )
+    )
+    assert all(isinstance(fragment, bytes) for fragment in fragments)
+    assert encoder.join(fragments) == json.dumps(payload_example).encode("utf-8")
+    assert encoder.join([]) == json.dumps([]).encode("utf-8")
+
+
+def test_get_payload_encoded_orjson_round_trip(
+    example_customers_dic, example_purchases_per_customer_dic, payload_example
+):
+    pytest.importorskip("orjson")
+    encoder = JSONEncoderBackend("orjson")
+    fragments = PayloadCreator.get_encoded_payload(
+        example_customers_dic, example_purchases_per_customer_dic, encoder
+    )
+    body = encoder.join(fragments)
+    assert json.loads(body) == payload_example
+    assert body == encoder.dumps(payload_example)
+
+
+def test_json_encoder_backend_orjson_large_integer(payload_example):
+    pytest.importorskip("orjson")
+    encoder = JSONEncoderBackend("orjson")
+    customer = dict(payload_example[1])
+    customer["purchases"] = [dict(customer["purchases"][0], quantity=10**20)]
+    fragments = [encoder.dumps(payload_example[0]), encoder.dumps(customer)]
+    body = encoder.join(fragments)
+    assert json.loads(body) == [payload_example[0], customer]
+    assert fragments[1] == json.dumps(customer, separators=(",", ":")).encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 64 * 1024])
+def test_json_encoder_backend_iter_join(payload_example, chunk_size):
+    encoder = JSONEncoderBackend("json")
+    fragments = [encoder.dumps(customer) for customer in payload_example]
+    chunks = list(encoder.iter_join(iter(fragments), chunk_size=chunk_size))
+    assert b"".join(chunks) == encoder.join(fragments)
+    assert b"".join(encoder.iter_join([], chunk_size=chunk_size)) == b"[]"
+    if chunk_size == 1:
+        assert len(chunks) == len(fragments) + 1
+
+
+def test_json_encoder_backend_not_supported():
+    with pytest.raises(ValueError):
+        JSONEncoderBackend("fake")
+
+
+def test_get_payload_spilled(purchases_csv_many, example_customers_dic):
+    customers = {str(k): dict(v) for k, v in example_customers_dic.items()}
+    in_memory = PurchaseCreator(purchases_csv_many.name).puchases_per_customer
+    spilled = PurchaseCreator(purchases_csv_many.name, max_memory=1).puchases_per_customer
+
+    expected = PayloadCreator.get_payload(
+        defaultdict(dict, {k: dict(v) for k, v in customers.items()}), in_memory
+    )
+    result = PayloadCreator.get_payload(
+        defaultdict(dict, {k: dict(v) for k, v in customers.items()}), spilled
+    )
+    assert result == expected
+    spilled.close()
+
+
+# ----------------------------------- #
+# Shard Tests
+# ----------------------------------- #
+
+
+@pytest.mark.parametrize("shard", ["0/1", "2/4", "3/4"])
+def test_parse_shard(shard):
+    index, count = parse_shard(shard)
+    assert f"{index}/{count}" == shard
+
+
+@pytest.mark.parametrize("shard", ["4/4", "-1/4", "0/0", "1", "a/b"])
+def test_parse_shard_bad(shard):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard(shard)
+
+
+def test_in_shard_stable():
+    # CRC32 based, so the assignment must not change between runs or hosts
+    assert [in_shard("1", (i, 4)) for i in range(4)] == [False, False, False, True]
+    assert [in_shard("2", (i, 4)) for i in range(4)] == [False, True, False, False]
+    assert in_shard("2", None)
+
+
+def test_read_csv_shards_partition(purchases_csv_many, customer_csv_path):
+    full = PurchaseCreator(purchases_csv_many.name)
+    merged_purchases = {}
+    merged_bad_purchases = {}
+    merged_customers = {}
+    for index in range(3):
+        shard_pc = PurchaseCreator(purchases_csv_many.name, shard=(index, 3))
+        shard_cc = CustomerCreator(customer_csv_path.name, shard=(index, 3))
+        shard_customers = shard_cc.read_customer_csv()
+        for customer_id in shard_pc.puchases_per_customer:
+            assert in_shard(customer_id, (index, 3))
+            assert customer_id not in merged_purchases
+        merged_purchases.update(shard_pc.puchases_per_customer)
+        merged_bad_purchases.update(shard_pc.bad_purchase_data)
+        merged_customers.update(shard_customers)
+
+    assert merged_purchases == dict(full.puchases_per_customer)
+    assert merged_bad_purchases == dict(full.bad_purchase_data)
+    assert merged_customers == dict(
+        CustomerCreator(customer_csv_path.name).read_customer_csv()
+    )
+
+
+def test_merge_shard_reports(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for index, customer in enumerate(["1", "2"]):
+        shard_dir = f"reports/shard_{index}_of_2"
+        os.makedirs(shard_dir)
+        with open(f"{shard_dir}/payload.json", "w") as json_file:
+            json.dump([{"email": f"{customer}@example.com"}], json_file)
+        with open(f"{shard_dir}/bad_purchases.json", "w") as json_file:
+            json.dump({customer: [{"customer_id": customer}]}, json_file)
+        with open(f"{shard_dir}/bad_customers.json", "w") as json_file:
+            json.dump({}, json_file)
+
+    merge_shard_reports(2)
+
+    with open("reports/payload.json") as json_file:
+        assert json.load(json_file) == [
+            {"email": "1@example.com"},
+            {"email": "2@example.com"},
+        ]
+    with open("reports/bad_purchases.json") as json_file:
+        assert json.load(json_file).keys() == {"1", "2"}
+    with open("reports/bad_customers.json") as json_file:
+        assert json.load(json_file) == {}
+
+
+@pytest.mark.parametrize("n_shards", [0, -1])
+def test_merge_shard_reports_bad_count(tmp_path, monkeypatch, n_shards):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("reports")
+    with pytest.raises(ValueError):
+        merge_shard_reports(n_shards)
+    assert os.listdir("reports") == []
+
+
+@pytest.mark.parametrize("count", ["0", "-2", "a"])
+def test_parse_shard_count_bad(count):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard_count(count)
+
+
+def test_run_merge_reports_help_without_reports(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["inflightpayment-mergereports", "--help"])
+    with pytest.raises(SystemExit) as e:
+        run_merge_reports()
+    assert e.value.code == 0
+
+
+def test_merge_shard_reports_missing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("reports")
+    with pytest.raises(FileNotFoundError):
+        merge_shard_reports(2)
+
+
 # ----------------------------------- #
 # Request Tests
 # ----------------------------------- #
@@ -147,6 +653,20 @@ def test_make_request_prod(capfd, payload_example):
         assert "data sent successfully" in out
 
 
+def test_make_request_encoded(payload_example):
+    mock = Mocker(real_http=True)
+    expected_response = {"status": "success", "data": payload_example, "message": None}
+    url = "https://dev.myhostname.com/v1/customers/"
+    mock.put(url, json=expected_response)
+    body = json.dumps(payload_example).encode("utf-8")
+    with mock:
+        api_response = make_request(body, "dev")
+        assert api_response == expected_response
+        assert mock.last_request.body == body
+    with open("reports/payload.json", "rb") as json_file:
+        assert json_file.read() == body
+
+
 @pytest.mark.parametrize("env", ["fake"])
 def test_make_request_fake(capfd, payload_example, env):
     mock = Mocker(real_http=True)
@@ -0,0 +1,191 @@
+import argparse
+import json
+import pytest
+import requests
+import sys
+
+from cli_paymentdata.cli_read_csv import make_request, run
+from cli_paymentdata.mock_api import (
+    MockCustomersAPI,
+    _parse_timeout,
+    _percentile,
+    load_test,
+)
+
+
+@pytest.fixture
+def mock_api(request):
+    # Options of the server can be given with indirect parametrization
+    server = MockCustomersAPI(**getattr(request, "param", {}))
+    server.start()
+    yield server
+    server.stop()
+
+
+# ----------------------------------- #
+# MockCustomersAPI Tests
+# ----------------------------------- #
+
+
+def test_mock_api_success(mock_api, payload_example):
+    api_response = make_request(payload_example, "dev", url=mock_api.url)
+    assert api_response == {
+        "status": "success",
+        "data": {"customers": len(payload_example)},
+        "message": None,
+    }
+
+
+def test_mock_api_reuses_connections(mock_api, payload_example):
+    body = json.dumps(payload_example).encode("utf-8")
+    with requests.Session() as session:
+        for _ in range(5):
+            make_request(body, "dev", url=mock_api.url, session=session)
+    assert mock_api.requests == 5
+    assert mock_api.connections == 1
+
+
+@pytest.mark.parametrize("mock_api", [{"max_body_size": 10}], indirect=True)
+def test_mock_api_body_size_limit(mock_api, payload_example):
+    response = requests.put(mock_api.url, data=json.dumps(payload_example))
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("mock_api", [{"error_rate": 1.0}], indirect=True)
+def test_mock_api_error_rate(capfd, mock_api, payload_example):
+    api_response = make_request(payload_example, "dev", url=mock_api.url)
+    assert api_response["status"] == "error"
+    out, err = capfd.readouterr()
+    assert "Status code: 500" in out
+
+
+@pytest.mark.parametrize("mock_api", [{"max_requests_per_second": 2}], indirect=True)
+def test_mock_api_throttling(mock_api, payload_example):
+    with requests.Session() as session:
+        status_codes = [
+            session.put(mock_api.url, data=json.dumps(payload_example)).status_code
+            for _ in range(3)
+        ]
+    assert status_codes[:2] == [200, 200]
+    assert status_codes[2] == 429
+
+
+@pytest.mark.parametrize("body", ["1", '{"customers": 1}', "not json"])
+def test_mock_api_bad_body(mock_api, body):
+    response = requests.put(mock_api.url, data=body)
+    assert response.status_code == 400
+    assert response.json()["status"] == "error"
+
+
+def test_mock_api_streamed_body(tmp_path, mock_api, payload_example):
+    body = json.dumps(payload_example).encode("utf-8")
+    chunks = (body[i:i + 50] for i in range(0, len(body), 50))
+    api_response = make_request(
+        chunks, "dev", url=mock_api.url, reports_dir=str(tmp_path)
+    )
+    assert api_response["data"] == {"customers": len(payload_example)}
+    assert (tmp_path / "payload.json").read_bytes() == body
+
+
+@pytest.mark.parametrize("mock_api", [{"max_body_size": 10}], indirect=True)
+def test_mock_api_streamed_body_size_limit(mock_api, payload_example):
+    body = json.dumps(payload_example).encode("utf-8")
+    response = requests.put(mock_api.url, data=iter([body[:5], body[5:]]))
+    assert response.status_code == 413
+
+
+def test_run_streams_payload(
+    tmp_path, monkeypatch, mock_api, purchases_csv_many, customer_csv_path
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "inflightpayment",
+            "-p",
+            purchases_csv_many.name,
+            "-c",
+            customer_csv_path.name,
+            "--url",
+            mock_api.url,
+            "--max-memory",
+            "1",
+            "--json-backend",
+            "json",
+        ],
+    )
+    run()
+    with open("reports/payload.json") as json_file:
+        payload = json.load(json_file)
+    assert len(payload) == 3
+    assert mock_api.requests == 1
+
+
+def test_mock_api_unknown_path(mock_api):
+    response = requests.put(mock_api.url + "unknown", data="[]")
+    assert response.status_code == 404
+
+
+# ----------------------------------- #
+# Load test Tests
+# ----------------------------------- #
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert _percentile(values, 50) == 50.0
+    assert _percentile(values, 99) == 99.0
+    assert _percentile([], 50) == 0.0
+
+
+def test_load_test(mock_api, purchases_csv_many, customer_csv_path):
+    report = load_test(
+        purchases_csv_many.name, customer_csv_path.name, mock_api.url, 10, 2
+    )
+    assert report["requests"] == 10
+    assert report["failed_requests"] == 0
+    assert report["error_rate"] == 0.0
+    assert report["timed_out_requests"] == 0
+    assert report["customers"] == 3
+    assert report["p50_ms"] <= report["p99_ms"] <= report["max_ms"]
+    assert mock_api.requests == 10
+    assert mock_api.connections <= 2
+
+
+@pytest.mark.parametrize(
+    "mock_api", [{"error_rate": 0.5, "latency": 0.01, "seed": 1}], indirect=True
+)
+def test_load_test_counts_failed_requests(
+    mock_api, purchases_csv_many, customer_csv_path
+):
+    report = load_test(
+        purchases_csv_many.name, customer_csv_path.name, mock_api.url, 20, 2
+    )
+    assert 0 < report["failed_requests"] < 20
+    assert report["error_rate"] == report["failed_requests"] / 20
+    # Failed requests also wait for the latency, and count in the percentiles
+    assert report["p50_ms"] >= 10
+    assert report["success_p50_ms"] >= 10
+
+
+@pytest.mark.parametrize("mock_api", [{"latency": 1.0}], indirect=True)
+def test_load_test_timeout(mock_api, purchases_csv_many, customer_csv_path):
+    report = load_test(
+        purchases_csv_many.name,
+        customer_csv_path.name,
+        mock_api.url,
+        2,
+        2,
+        timeout=0.1,
+    )
+    assert report["failed_requests"] == 2
+    assert report["timed_out_requests"] == 2
+    assert report["error_rate"] == 1.0
+    assert report["max_ms"] < 1000
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "a"])
+def test_parse_timeout_bad(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        _parse_timeout(value)